@@ -26,35 +26,171 @@ import os
 import bz2
 import lzma
 import glob
+import collections
+import multiprocessing
+import threading
+import importlib
+from concurrent.futures import ProcessPoolExecutor
 
 from core.database import database
 from core.data.RaftDbCapture import RaftDbCapture
 
 from utility.ScriptLoader import ScriptLoader
 
-from lib.parsers.burpparse import burp_parse_log, burp_parse_state, burp_parse_xml, burp_parse_vuln_xml
-from lib.parsers.webscarabparse import webscarab_parse_conversation
-from lib.parsers.parosparse import paros_parse_message
-from lib.parsers.raftparse import raft_parse_xml, ParseAdapter
-from lib.parsers.appscanparse import appscan_parse_xml
+from lib.parsers.raftparse import ParseAdapter
 
 from raft import __version__
 
+def _run_captures(results, adapt, accept, process):
+    """ Adapt each parser result, then filter and process the capture """
+    # the usual shapes (a filter and a processor, or just a processor)
+    # get straight-line loops with no per-stage iterator overhead
+    if accept is not None and process is not None:
+        for result in results:
+            capture = adapt(result)
+            if accept(capture):
+                process(capture)
+        return
+    elif process is not None:
+        for result in results:
+            process(adapt(result))
+        return
+
+    captures = map(adapt, results)
+    if accept is not None:
+        captures = filter(accept, captures)
+    # drain the pipeline without keeping results
+    collections.deque(captures, maxlen=0)
+
+# use the compiled loop when Cython is available; parser worker
+# processes never run captures, so they skip the build
+if 'MainProcess' == multiprocessing.current_process().name:
+    try:
+        import pyximport
+    except ImportError:
+        pass
+    else:
+        importers = pyximport.install(language_level = 3)
+        try:
+            from lib.capturedispatch import run_captures as _run_captures
+        except ImportError:
+            pass
+        finally:
+            # do not leave the .pyx import hook installed for the process
+            pyximport.uninstall(*importers)
+
+def _expand_paths(patterns, trust_paths = False):
+    """ Expand a list of file arguments into a stream of file names """
+    for filearg in patterns:
+        if filearg.startswith('~'):
+            filearg = os.path.expanduser(filearg)
+        if '$' in filearg or '%' in filearg:
+            filearg = os.path.expandvars(filearg)
+        if '*' in filearg:
+            yield from glob.iglob(filearg)
+        elif trust_paths or os.path.exists(filearg):
+            yield filearg
+
+def _read_file(filename):
+    """ Read through a file, discarding the contents """
+    try:
+        with open(filename, 'rb') as fh:
+            while fh.read(1024*1024):
+                pass
+    except OSError:
+        pass
+
+def _prefetch_file(filename):
+    """ Start pulling a file into the OS page cache in the background """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+    else:
+        thread = threading.Thread(target = _read_file, args = (filename,))
+        thread.daemon = True
+        thread.start()
+
+def _generate_chain(name, funcs, joiner, prefix = ''):
+    """ Generate a function that applies each of funcs to a capture in turn """
+    args = ', '.join('_f%d=funcs[%d]' % (i, i) for i in range(len(funcs)))
+    calls = joiner.join('_f%d(capture)' % (i) for i in range(len(funcs)))
+    source = 'def %s(capture, %s):\n    %s%s\n' % (name, args, prefix, calls)
+    namespace = {'funcs' : funcs}
+    exec(compile(source, '<%s>' % (name), 'exec'), namespace)
+    return namespace[name]
+
+def _chain_filters(filters):
+    """ Fold capture filters into a single predicate """
+    if not filters:
+        return None
+    if 1 == len(filters):
+        return filters[0]
+    # short-circuit "and" stops at the first filter that rejects
+    return _generate_chain('capture_filters', filters, ' and ', 'return ')
+
+def _chain_processors(processors):
+    """ Fold capture processors into a single callable """
+    if not processors:
+        return None
+    if 1 == len(processors):
+        return processors[0]
+    return _generate_chain('capture_processors', processors, '\n    ')
+
+def _parse_worker(func, filename):
+    """ Run one parser in a worker process and return all of its results """
+    return list(func(filename))
+
+def _future_results(future):
+    """ Yield parsed results, raising any worker failure on first iteration """
+    yield from future.result()
+
+class CaptureScriptEnv():
+    """ A loaded capture script with its hooks resolved and per-run state """
+    __slots__ = ('filename', 'loaded', 'initialize', 'finalize', 'begin', 'end',
+                 'capture_filter', 'process_capture', 'initialized', 'finalized',
+                 'begin_serial', 'end_serial')
+
+    def __init__(self, filename, loaded):
+        self.filename = filename
+        self.loaded = loaded
+        functions = loaded.functions
+        self.initialize = functions.get('initialize')
+        self.finalize = functions.get('finalize')
+        self.begin = functions.get('begin')
+        self.end = functions.get('end')
+        self.capture_filter = functions.get('capture_filter')
+        self.process_capture = functions.get('process_capture')
+        self.initialized = False
+        self.finalized = False
+        self.begin_serial = 0
+        self.end_serial = 0
+
 class RaftCmdLine():
     # TODO: refactor this definition to be shared with importers
-    FILE_PROCESSOR_DEFINTIONS = {
-        'raft_capture_xml' : raft_parse_xml,
-        'burp_log' : burp_parse_log,
-        'burp_xml' : burp_parse_xml,
-        'burp_vuln_xml' : burp_parse_vuln_xml,
-        'burp_state' : burp_parse_state,
-        'appscan_xml' : appscan_parse_xml,
-        'webscarab' : webscarab_parse_conversation,
-        'paros_message' : paros_parse_message,
-        }
+    # parser modules are only imported when their option is used
+    FILE_PROCESSOR_DEFINTIONS = (
+        ('raft_capture_xml', 'lib.parsers.raftparse', 'raft_parse_xml'),
+        ('burp_log', 'lib.parsers.burpparse', 'burp_parse_log'),
+        ('burp_xml', 'lib.parsers.burpparse', 'burp_parse_xml'),
+        ('burp_vuln_xml', 'lib.parsers.burpparse', 'burp_parse_vuln_xml'),
+        ('burp_state', 'lib.parsers.burpparse', 'burp_parse_state'),
+        ('appscan_xml', 'lib.parsers.appscanparse', 'appscan_parse_xml'),
+        ('webscarab', 'lib.parsers.webscarabparse', 'webscarab_parse_conversation'),
+        ('paros_message', 'lib.parsers.parosparse', 'paros_parse_message'),
+        )
     def __init__(self):
         self.scripts = {}
-        self.scriptLoader = ScriptLoader()
+        self.script_file_serial = 0
+        # ParseAdapter holds no per-file state, so one instance serves the run
+        self.adapter = ParseAdapter()
+        # capture scripts are compiled without asserts and docstrings
+        self.scriptLoader = ScriptLoader(os.path.join(os.path.expanduser('~'), '.raft', 'script_cache'), optimize = 2)
         self.Data = None
 
     def cleanup(self):
@@ -63,13 +199,14 @@ class RaftCmdLine():
 
     def process_args(self, args):
 
-        do_create = getattr(args, 'create')
-        do_import = getattr(args, 'import')
-        do_export = getattr(args, 'export')
-        do_parse = getattr(args, 'parse')
+        opts = vars(args)
+        do_create = opts.get('create')
+        do_import = opts.get('import')
+        do_export = opts.get('export')
+        do_parse = opts.get('parse')
 
         # was DB file specified?
-        db_filename = getattr(args, 'db')
+        db_filename = opts.get('db')
         if db_filename is not None:
             if not db_filename.endswith('.raftdb'):
                 db_filename += '.raftdb'
@@ -91,20 +228,22 @@ class RaftCmdLine():
 
         # setup any capture filters
         self.capture_filter_scripts = []
-        arg = getattr(args, 'capture_filter')
+        arg = opts.get('capture_filter')
         if arg is not None:
             for filearg in arg:
                 self.capture_filter_scripts.append(self.load_script_file(filearg))
 
         # setup any capture filters
         self.process_capture_scripts = []
-        arg = getattr(args, 'process_capture')
+        arg = opts.get('process_capture')
         if arg is not None:
             for filearg in arg:
                 self.process_capture_scripts.append(self.load_script_file(filearg))
 
+        self.setup_capture_chains()
+
         if do_export:
-            filename = getattr(args, 'output_file')
+            filename = opts.get('output_file')
             if filename.endswith('.xml.xz'):
                 fh = lzma.LZMAFile(filename, 'w')
             elif filename.endswith('.xml.bz2'):
@@ -116,9 +255,9 @@ class RaftCmdLine():
                 return 1
             self.export_to_raft_capture(filename, fh)
         elif do_import:
-            self.run_process_loop(args, self.import_one_file)
+            self.run_process_loop(opts, self.import_one_file)
         elif do_parse:
-            self.run_process_loop(args, self.parse_one_file)
+            self.run_process_loop(opts, self.parse_one_file)
         else:
             sys.stderr.write('\nNo recognized options\n')
 
@@ -127,48 +266,89 @@ class RaftCmdLine():
     def report_exception(self, error):
         print(error)
 
+    def setup_capture_chains(self):
+        """ Resolve capture filters and processors once for the run """
+        self.capture_filters = [script_env.capture_filter
+                                for script_env in self.capture_filter_scripts
+                                if script_env.capture_filter is not None]
+        self.capture_processors = [script_env.process_capture
+                                   for script_env in self.process_capture_scripts
+                                   if script_env.process_capture is not None]
+        self.capture_filter_chain = _chain_filters(self.capture_filters)
+        self.capture_processor_chain = _chain_processors(self.capture_processors)
+
     def setup_script_initializers(self):
         for key, script_env in self.scripts.items():
-            initializer = script_env.functions.get('initialize')
-            if initializer and not script_env['initialized']:
-                initializer()
-                script_env['initialized'] = True
+            if script_env.initialize and not script_env.initialized:
+                script_env.initialize()
+                script_env.initialized = True
 
     def setup_script_finalizers(self):
         for key, script_env in self.scripts.items():
-            finalizer = script_env.functions.get('finalize')
-            if finalizer and not script_env['finalized']:
-                finalizer()
-                script_env['finalized'] = True
+            if script_env.finalize and not script_env.finalized:
+                script_env.finalize()
+                script_env.finalized = True
 
     def reset_script_begin_end(self):
-        for key, script_env in self.scripts.items():
-            script_env['begin_called'] = False
-            script_env['end_called'] = False
+        # scripts record the serial of the last file they saw begin/end for
+        self.script_file_serial += 1
 
-    def call_script_method_with_filename(self, script_env, method, filename):
-        method_func = script_env.functions.get(method)
-        if method_func and not script_env[method + '_called']:
-            method_func(filename)
-            script_env[method + '_called'] = True
+    def call_script_begin(self, script_env, filename):
+        if script_env.begin and script_env.begin_serial != self.script_file_serial:
+            script_env.begin(filename)
+            script_env.begin_serial = self.script_file_serial
 
-    def run_process_loop(self, args, call_func):
+    def call_script_end(self, script_env, filename):
+        if script_env.end and script_env.end_serial != self.script_file_serial:
+            script_env.end(filename)
+            script_env.end_serial = self.script_file_serial
+
+    def run_process_loop(self, opts, call_func):
         self.setup_script_initializers()
-        for name, func in self.FILE_PROCESSOR_DEFINTIONS.items():
-            arg = getattr(args, name)
+        trust_paths = opts.get('trust_paths')
+        work = []
+        for name, module_name, func_name in self.FILE_PROCESSOR_DEFINTIONS:
+            arg = opts.get(name)
             if arg is None:
                 continue
-            for filearg in arg:
-                if filearg.startswith('~'):
-                    filearg = os.path.expanduser(filearg)
-                if '$' in filearg or '%' in filearg:
-                    filearg = os.path.expandvars(filearg)
-                if '*' in filearg:
-                    file_list = glob.glob(filearg)
-                elif os.path.exists(filearg):
-                    file_list = [filearg]
-                for filename in file_list:
-                    call_func(filename, func, name)
+            func = getattr(importlib.import_module(module_name), func_name)
+            for filename in _expand_paths(arg, trust_paths):
+                work.append((filename, func, name))
+
+        jobs = opts.get('jobs', 1)
+        if 0 == jobs:
+            jobs = multiprocessing.cpu_count()
+        if jobs > 1 and len(work) > 1:
+            # parsers run in worker processes, but scripts and database
+            # writes stay in this process and see files in order
+            jobs = min(jobs, len(work))
+            work_items = iter(work)
+            pending = collections.deque()
+            with ProcessPoolExecutor(max_workers = jobs) as executor:
+                def submit_next():
+                    item = next(work_items, None)
+                    if item is not None:
+                        filename, func, name = item
+                        pending.append((item, executor.submit(_parse_worker, func, filename)))
+
+                # only keep about one parsed file per worker in memory
+                for i in range(jobs):
+                    submit_next()
+                try:
+                    while pending:
+                        (filename, func, name), future = pending.popleft()
+                        submit_next()
+                        call_func(filename, func, name, _future_results(future))
+                except BaseException:
+                    for item, future in pending:
+                        future.cancel()
+                    raise
+        else:
+            for index, (filename, func, name) in enumerate(work):
+                # overlap reading the next file with parsing this one
+                if index + 1 < len(work):
+                    _prefetch_file(work[index + 1][0])
+                call_func(filename, func, name)
         self.setup_script_finalizers()
 
     def export_to_raft_capture(self, filename, fhandle):
@@ -176,14 +356,11 @@ class RaftCmdLine():
         sys.stderr.write('\nExporting to [%s]\n' % (filename))
         self.reset_script_begin_end()
         self.setup_script_initializers()
-        filters = []
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'begin', filename)
-            capture_filter = script_env.functions.get('capture_filter')
-            if capture_filter:
-                filters.append(capture_filter)
+            self.call_script_begin(script_env, filename)
 
-        adapter = ParseAdapter()
+        accept = self.capture_filter_chain
+        adapter = self.adapter
         count = 0
         Data = self.Data
         cursor = Data.allocate_thread_cursor()
@@ -193,14 +370,7 @@ class RaftCmdLine():
                 capture = RaftDbCapture()
                 capture.populate_by_dbrow(row)
 
-                skip = False
-                for capture_filter in filters:
-                    result = capture_filter(capture)
-                    if not result:
-                        skip = True
-                        break
-
-                if not skip:
+                if accept is None or accept(capture):
                     fhandle.write(adapter.format_as_xml(capture).encode('utf-8'))
                     count += 1
 
@@ -215,37 +385,30 @@ class RaftCmdLine():
             Data, cursor = None, None
 
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'end', filename)
+            self.call_script_end(script_env, filename)
 
         self.setup_script_finalizers()
 
-    def import_one_file(self, filename, func, funcname):
+    def import_one_file(self, filename, func, funcname, results = None):
         """ Import one file using specified parser function"""
-        adapter = ParseAdapter()
+        adapter = self.adapter
         sys.stderr.write('\nImporting [%s]\n' % (filename))
         self.reset_script_begin_end()
-        filters = []
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'begin', filename)
-            capture_filter = script_env.functions.get('capture_filter')
-            if capture_filter:
-                filters.append(capture_filter)
+            self.call_script_begin(script_env, filename)
 
+        accept = self.capture_filter_chain
         count = 0
         commit_threshold = 100
         Data = self.Data
         cursor = Data.allocate_thread_cursor()
         try:
             Data.set_insert_pragmas(cursor)
-            for result in func(filename):
+            if results is None:
+                results = func(filename)
+            for result in results:
                 capture = adapter.adapt(result)
-                skip = False
-                for capture_filter in filters:
-                    result = capture_filter(capture)
-                    if not result:
-                        skip = True
-                        break
-                if not skip:
+                if accept is None or accept(capture):
                     insertlist = [None, capture.url, capture.request_headers, capture.request_body, capture.response_headers, capture.response_body,
                                   capture.status, capture.content_length, capture.elapsed, capture.datetime, capture.notes, None, capture.confirmed, 
                                   capture.method, capture.hostip, capture.content_type, '%s-%s' % (funcname, capture.origin), capture.host]
@@ -261,9 +424,9 @@ class RaftCmdLine():
 
         except Exception as error:
             Data.rollback()
-            print(error)
+            sys.stderr.write('%s: %s\n' % (type(error).__name__, error))
             # TODO: should continue(?)
-            raise error
+            raise
         finally:
             Data.reset_pragmas(cursor)
             cursor.close()
@@ -271,54 +434,35 @@ class RaftCmdLine():
             Data, cursor = None, None
 
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'end', filename)
+            self.call_script_end(script_env, filename)
 
-    def parse_one_file(self, filename, func, funcname):
+    def parse_one_file(self, filename, func, funcname, results = None):
         """ Parse one file using specified parser function"""
-        adapter = ParseAdapter()
         sys.stderr.write('\nProcessing [%s]\n' % (filename))
         self.reset_script_begin_end()
-        filters = []
-        processors = []
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'begin', filename)
-            capture_filter = script_env.functions.get('capture_filter')
-            if capture_filter:
-                filters.append(capture_filter)
+            self.call_script_begin(script_env, filename)
         for script_env in self.process_capture_scripts:
-            self.call_script_method_with_filename(script_env, 'begin', filename)
-            process_capture = script_env.functions.get('process_capture')
-            if process_capture:
-                processors.append(process_capture)
+            self.call_script_begin(script_env, filename)
         try:
-            for result in func(filename):
-                capture = adapter.adapt(result)
-                skip = False
-                for capture_filter in filters:
-                    result = capture_filter(capture)
-                    if not result:
-                        skip = True
-                        break
-                if not skip:
-                    for processor in processors:
-                        result = processor(capture)
+            if results is None:
+                results = func(filename)
+            _run_captures(results, self.adapter.adapt, self.capture_filter_chain, self.capture_processor_chain)
 
         except Exception as error:
-            print(error)
+            sys.stderr.write('%s: %s\n' % (type(error).__name__, error))
             # TODO: should continue(?)
-            raise error
+            raise
 
         for script_env in self.capture_filter_scripts:
-            self.call_script_method_with_filename(script_env, 'end', filename)
+            self.call_script_end(script_env, filename)
         for script_env in self.process_capture_scripts:
-            self.call_script_method_with_filename(script_env, 'end', filename)
+            self.call_script_end(script_env, filename)
 
     def load_script_file(self, filename):
         if filename in self.scripts:
             return self.scripts[filename]
-        script_env = self.scriptLoader.load_from_file(filename)
-        script_env['initialized'] = False
-        script_env['finalized'] = False
+        script_env = CaptureScriptEnv(filename, self.scriptLoader.load_from_file(filename))
         self.scripts[filename] = script_env
         return script_env
 
@@ -331,6 +475,8 @@ def main():
     parser.add_argument('--import', action='store_const', const=True, default=False, help='Import list of files into database')
     parser.add_argument('--export', action='store_const', const=True, default=False, help='Export the RAFT database into a RAFT XML capture file')
     parser.add_argument('--parse', action='store_const', const=True, default=False, help='Parse list of files and run processing')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used to parse input files (0 for one per CPU)')
+    parser.add_argument('--trust-paths', action='store_const', const=True, default=False, help='Do not check that literal input file paths exist')
     parser.add_argument('--output-file', nargs='?', help='Output file to write results into')
     parser.add_argument('--capture-filter', nargs='*', help='A Python file with a function or single class containing: "capture_filter"')
     parser.add_argument('--process-capture', nargs='*', help='A Python file with a function or single class containing: "process_capture"')
@@ -0,0 +1,32 @@
+#
+# Compiled inner loop for running parsed captures through filters and processors
+#
+# Copyright (c) 2013 RAFT Team
+#
+# This file is part of RAFT.
+#
+# RAFT is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# RAFT is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RAFT.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+def run_captures(results, adapt, accept, process):
+    """ Adapt each parser result, then filter and process the capture """
+    cdef object result, capture
+    cdef bint has_accept = accept is not None
+    cdef bint has_process = process is not None
+    for result in results:
+        capture = adapt(result)
+        if has_accept and not accept(capture):
+            continue
+        if has_process:
+            process(capture)
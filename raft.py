@@ -27,12 +27,16 @@
 #
 import sys
 import os
+import multiprocessing
 
 __version__ = "3.0.1"
 __all__ = ['__version__']
 
 def main():
 
+    # frozen Windows builds start --jobs workers through this entry point
+    multiprocessing.freeze_support()
+
     # TODO: for base Win32, no stdin/stdout
 
     # for now, just to maintain compatibility
@@ -22,6 +22,10 @@
 #
 
 import sys
+import os
+import hashlib
+import marshal
+import inspect
 
 class ScriptEnv():
     def __init__(self, global_ns = None, local_ns = None):
@@ -45,8 +49,11 @@ class ScriptEnv():
         self._properties[name] = value
 
 class ScriptLoader():
-    def __init__(self):
-        pass
+    def __init__(self, cache_dir = None, optimize = -1):
+        # if cache_dir is set, compiled code objects are also persisted there
+        self.cache_dir = cache_dir
+        self.optimize = optimize
+        self._code_cache = {}
 
     def load_from_string(self, python_code, global_ns = None, local_ns = None):
         script_env = ScriptEnv(global_ns, local_ns)
@@ -54,28 +61,72 @@ class ScriptLoader():
         return script_env
 
     def load_from_file(self, filename, global_ns = None, local_ns = None):
-        fh = open(filename, 'rb')
-        python_code = fh.read()
-        fh.close()
+        with open(filename, 'rb') as fh:
+            python_code = fh.read()
         script_env = ScriptEnv(global_ns, local_ns)
-        self.load_python_code(script_env, python_code)
+        self.load_python_code(script_env, python_code, filename)
         return script_env
 
-    def load_python_code(self, script_env, python_code):
+    def compile_python_code(self, python_code, filename = '<string>'):
+        """ Compile source, reusing code objects keyed by SHA-256 of the source """
+        sha256 = hashlib.sha256()
+        if str == type(python_code):
+            sha256.update(python_code.encode('utf-8'))
+        else:
+            sha256.update(python_code)
+        # code objects also embed the filename and optimization level
+        sha256.update(('\0%s\0%d' % (filename, self.optimize)).encode('utf-8'))
+        digest = sha256.hexdigest()
+
+        compiled = self._code_cache.get(digest)
+        if compiled is not None:
+            return compiled
+
+        cache_filename = None
+        if self.cache_dir and not filename.startswith('<'):
+            # one entry per script path, overwritten when the source changes;
+            # marshal format is specific to the interpreter version
+            cache_tag = getattr(sys.implementation, 'cache_tag', None) or 'python'
+            path_digest = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()
+            cache_filename = os.path.join(self.cache_dir, '%s.%s.pyc' % (path_digest, cache_tag))
+            if os.path.exists(cache_filename):
+                try:
+                    with open(cache_filename, 'rb') as fh:
+                        # entry starts with the digest of the source it was compiled from
+                        if fh.read(len(digest)) == digest.encode('ascii'):
+                            compiled = marshal.load(fh)
+                except (OSError, EOFError, ValueError, TypeError):
+                    compiled = None
+
+        if compiled is None:
+            compiled = compile(python_code, filename, 'exec', dont_inherit = True, optimize = self.optimize)
+            if cache_filename:
+                try:
+                    if not os.path.exists(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    tmp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+                    with open(tmp_filename, 'wb') as fh:
+                        fh.write(digest.encode('ascii'))
+                        marshal.dump(compiled, fh)
+                    os.replace(tmp_filename, cache_filename)
+                except OSError as error:
+                    sys.stderr.write('Failed to cache compiled code: %s\n' % (error))
+
+        self._code_cache[digest] = compiled
+        return compiled
+
+    def load_python_code(self, script_env, python_code, filename = '<string>'):
         try:
-            compiled = compile(python_code, '<string>', 'exec')
+            compiled = self.compile_python_code(python_code, filename)
             exec(compiled, script_env.global_ns, script_env.local_ns)
-            for key in script_env.local_ns:
-                value = script_env.local_ns[key]
-                if str(type(value)) == "<class 'type'>":
+            for key, value in list(script_env.local_ns.items()):
+                if type(value) is type:
                     instance = value()
                     script_env.instance = instance
-                    for item in dir(instance):
+                    for item, itemvalue in inspect.getmembers(instance, inspect.ismethod):
                         if not item.startswith('_'):
-                            itemvalue = getattr(instance, item)
-                            if str(type(itemvalue)) == "<class 'method'>":
-                                script_env.functions[item] = itemvalue
-                elif str(type(value)) == "<class 'function'>":
+                            script_env.functions[item] = itemvalue
+                elif inspect.isfunction(value):
                     script_env.functions[key] = value
 
         except Exception as error: